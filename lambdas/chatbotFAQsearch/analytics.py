@@ -0,0 +1,377 @@
+"""
+Unanswered / ambiguous query analytics for chatbotFAQsearch.
+
+Replies only do an in-memory counter update. The aggregated counts are
+written in bulk, either to a DynamoDB table with BatchWriteItem
+(ANALYTICS_TABLE) or to a JSON-lines file (ANALYTICS_FILE). With neither set,
+recording is a no-op.
+
+A background thread flushes every ANALYTICS_FLUSH_S, but it only runs while a
+Lambda invocation is thawed and atexit does not fire for reclaimed Lambda
+environments or multiprocessing workers. So the Telegram webhook path calls
+flush_if_due(deadline) once the reply is sent, and server.py workers flush when
+they shut down. A flush given a deadline stops between BatchWriteItem calls
+when less than ANALYTICS_FLUSH_MIN_S is left; rows it did not write go back
+into the current window.
+
+Each flushed row is one (kind, normalized query) for one flush window:
+    pk="[<tenant>#]unanswered#do you sell pets", sk="<window start>#<instance>",
+    kind, query, count, candidates (top FAQ ids / Lex intents), first_seen, last_seen,
+    tenant (when the request was routed to a tenant)
+"""
+import atexit
+import json
+import os
+import threading
+import time
+import traceback
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+
+import boto3
+from botocore.config import Config
+
+# ====== Constants ======
+ANALYTICS_TABLE        = os.getenv("ANALYTICS_TABLE")
+ANALYTICS_FILE         = os.getenv("ANALYTICS_FILE")
+ANALYTICS_ENDPOINT_URL = os.getenv("ANALYTICS_ENDPOINT_URL")   # e.g. DynamoDB Local
+REGION_NAME            = os.getenv("REGION_NAME", "us-east-1")
+FLUSH_INTERVAL_S       = float(os.getenv("ANALYTICS_FLUSH_S", "60"))
+MAX_KEYS               = int(os.getenv("ANALYTICS_MAX_KEYS", "5000"))   # distinct queries held between flushes
+MAX_QUERY_LEN          = 200
+MAX_CANDIDATES         = 3
+BATCH_SIZE             = 25    # BatchWriteItem limit
+BATCH_RETRIES          = 3
+FLUSH_MIN_BUDGET_S     = float(os.getenv("ANALYTICS_FLUSH_MIN_S", "1.5"))   # no BatchWriteItem call with less left
+SINK_CONFIG            = Config(connect_timeout=0.5, read_timeout=1,   # one call takes at most ~1.5s
+                                retries={"total_max_attempts": 1})
+
+KIND_UNANSWERED   = "unanswered"
+KIND_AMBIGUOUS    = "ambiguous"
+KIND_LEX_FALLBACK = "lex_fallback"
+
+
+def _utc_iso(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat(timespec="seconds")
+
+def _out_of_time(deadline, needed=FLUSH_MIN_BUDGET_S):
+    """True when `deadline` (a time.monotonic() timestamp, or None) leaves less than `needed` seconds."""
+    return deadline is not None and deadline - time.monotonic() < needed
+
+
+# ====== Sinks ======
+class FileSink:
+    """Append one JSON object per row. Local and fast, so the deadline is ignored."""
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, rows, deadline=None):
+        with open(self.path, "a", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        return []
+
+
+class DynamoDBSink:
+    """
+    Write rows with BatchWriteItem, 25 at a time, retrying UnprocessedItems.
+    write() returns the rows it did not get to: out of time, still unprocessed
+    after BATCH_RETRIES, or behind a failed call.
+    """
+    def __init__(self, table_name, client=None):
+        from boto3.dynamodb.types import TypeSerializer
+        self.table_name = table_name
+        self.client = client or boto3.client("dynamodb", region_name=REGION_NAME,
+                                             endpoint_url=ANALYTICS_ENDPOINT_URL, config=SINK_CONFIG)
+        self._serializer = TypeSerializer()
+
+    def _put(self, row):
+        item = {k: self._serializer.serialize(v) for k, v in row.items()}
+        return {"PutRequest": {"Item": item}}
+
+    def write(self, rows, deadline=None):
+        by_key = {(r["pk"], r["sk"]): r for r in rows}
+        def unwritten(requests, i):
+            keys = [(q["PutRequest"]["Item"]["pk"]["S"], q["PutRequest"]["Item"]["sk"]["S"]) for q in requests]
+            return [by_key[k] for k in keys] + rows[i + BATCH_SIZE:]
+
+        for i in range(0, len(rows), BATCH_SIZE):
+            requests = [self._put(r) for r in rows[i:i + BATCH_SIZE]]
+            for attempt in range(BATCH_RETRIES + 1):
+                if _out_of_time(deadline):
+                    return unwritten(requests, i)
+                try:
+                    resp = self.client.batch_write_item(RequestItems={self.table_name: requests})
+                except Exception as e:
+                    print("Analytics batch write error:", repr(e))
+                    return unwritten(requests, i)
+                requests = (resp.get("UnprocessedItems") or {}).get(self.table_name) or []
+                if not requests:
+                    break
+                if attempt < BATCH_RETRIES:
+                    time.sleep(0.05 * 2 ** attempt)
+            if requests:
+                return unwritten(requests, i)
+        return []
+
+
+def sink_from_env():
+    if ANALYTICS_TABLE:
+        return DynamoDBSink(ANALYTICS_TABLE)
+    if ANALYTICS_FILE:
+        return FileSink(ANALYTICS_FILE)
+    return None
+
+
+# ====== Aggregator ======
+class QueryAggregator:
+    """
+    Counts (kind, normalized query) pairs in memory and flushes them in bulk
+    from a background thread, so recording never waits on I/O.
+    """
+    def __init__(self, sink, flush_interval=FLUSH_INTERVAL_S, max_keys=MAX_KEYS):
+        self.sink = sink
+        self.flush_interval = flush_interval
+        self.max_keys = max_keys
+        self.instance = uuid.uuid4().hex[:8]
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._reset()
+
+    def _after_fork(self):
+        # Forked workers start empty, with their own id so their rows don't collide
+        self.instance = uuid.uuid4().hex[:8]
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._reset()
+
+    def _reset(self):
+        self._window_start = time.time()
+        self._counts = {}   # (tenant, kind, query) -> [count, Counter(candidates), first_seen, last_seen]
+
+    def record(self, kind, query, candidates=(), tenant=None):
+        if self.sink is None:
+            return
+        query = " ".join((query or "").split())[:MAX_QUERY_LEN]
+        if not query:
+            return
+        now = time.time()
+        key = (tenant, kind, query)
+        with self._lock:
+            if not self._counts:
+                self._window_start = now   # windows start at the first miss, not the last flush
+            entry = self._counts.get(key)
+            if entry is None:
+                if len(self._counts) >= self.max_keys:
+                    self.dropped += 1
+                    self._wake.set()
+                    return
+                entry = self._counts[key] = [0, Counter(), now, now]
+                if len(self._counts) >= self.max_keys:
+                    self._wake.set()
+            entry[0] += 1
+            entry[1].update(str(c) for c in list(candidates)[:MAX_CANDIDATES] if c)
+            entry[3] = now
+        self._ensure_thread()
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="query-analytics", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def _drain(self):
+        with self._lock:
+            counts, window_start, dropped = self._counts, self._window_start, self.dropped
+            self.dropped = 0
+            self._reset()
+        window = f"{_utc_iso(window_start)}#{self.instance}"
+        rows = []
+        for (tenant, kind, query), (count, candidates, first_seen, last_seen) in counts.items():
+            row = {
+                "pk": f"{tenant}#{kind}#{query}" if tenant else f"{kind}#{query}",
+                "sk": window,
+                "kind": kind,
+                "query": query,
+                "count": count,
+                "candidates": [c for c, _ in candidates.most_common(MAX_CANDIDATES)],
+                "first_seen": _utc_iso(first_seen),
+                "last_seen": _utc_iso(last_seen),
+            }
+            if tenant:
+                row["tenant"] = tenant
+            rows.append(row)
+        return counts, rows, dropped
+
+    def flush_due(self):
+        """True when the current window is old enough (or full enough) to write."""
+        with self._lock:
+            if not self._counts and not self.dropped:
+                return False
+            return (len(self._counts) >= self.max_keys
+                    or time.time() - self._window_start >= self.flush_interval)
+
+    def flush_if_due(self, deadline=None):
+        if self.sink is None or not self.flush_due():
+            return 0
+        return self.flush(deadline)
+
+    def flush(self, deadline=None):
+        """
+        Write everything recorded so far, stopping early if `deadline` (a
+        monotonic() timestamp) gets close. Rows not written are put back into
+        the current window. Returns the number of rows written.
+        """
+        if self.sink is None or _out_of_time(deadline):
+            return 0
+        with self._flush_lock:
+            counts, rows, dropped = self._drain()
+            if dropped:
+                print(f"Analytics: {dropped} queries not counted, key limit {self.max_keys} reached")
+            if not rows:
+                return 0
+            try:
+                left = self.sink.write(rows, deadline)
+            except Exception as e:
+                print("Analytics flush error:", repr(e))
+                traceback.print_exc()
+                left = rows
+            if left:
+                self._requeue(counts, left)
+            return len(rows) - len(left)
+
+    def _requeue(self, counts, rows):
+        """Merge the counts behind unwritten `rows` back into the current window."""
+        with self._lock:
+            if not self._counts:
+                self._window_start = time.time()
+            for row in rows:
+                key = (row.get("tenant"), row["kind"], row["query"])
+                count, candidates, first_seen, last_seen = counts[key]
+                entry = self._counts.get(key)
+                if entry is None:
+                    self._counts[key] = [count, candidates, first_seen, last_seen]
+                else:
+                    entry[0] += count
+                    entry[1].update(candidates)
+                    entry[2] = min(entry[2], first_seen)
+                    entry[3] = max(entry[3], last_seen)
+        print(f"Analytics: {len(rows)} rows not written, kept for the next flush")
+
+
+# ====== Module-level aggregator ======
+aggregator = QueryAggregator(sink_from_env())
+atexit.register(aggregator.flush)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=aggregator._after_fork)
+
+def record(kind, query, candidates=(), tenant=None):
+    aggregator.record(kind, query, candidates, tenant)
+
+
+# ====== Self-test ======
+class _StubDynamoDB:
+    """Stand-in batch_write_item client: records calls, rejects items or fails on request."""
+    def __init__(self, unprocessed_on_first=0, delay=0.0, fail_first=False):
+        self.calls = []
+        self.items = []
+        self.unprocessed_on_first = unprocessed_on_first
+        self.delay = delay
+        self.fail_first = fail_first
+
+    def batch_write_item(self, RequestItems):
+        (table_name, requests), = RequestItems.items()
+        self.calls.append(len(requests))
+        time.sleep(self.delay)
+        if len(self.calls) == 1 and self.fail_first:
+            raise ConnectionError("stub: first call fails")
+        if len(self.calls) == 1 and self.unprocessed_on_first:
+            keep = requests[:-self.unprocessed_on_first]
+            self.items.extend(r["PutRequest"]["Item"] for r in keep)
+            return {"UnprocessedItems": {table_name: requests[-self.unprocessed_on_first:]}}
+        self.items.extend(r["PutRequest"]["Item"] for r in requests)
+        return {"UnprocessedItems": {}}
+
+def _selftest():
+    """
+    Exercise DynamoDBSink against a stub client, or against DynamoDB Local when
+    ANALYTICS_ENDPOINT_URL and ANALYTICS_TABLE are set.
+    """
+    if ANALYTICS_ENDPOINT_URL and ANALYTICS_TABLE:
+        sink = DynamoDBSink(ANALYTICS_TABLE)
+        agg = QueryAggregator(sink, flush_interval=3600)
+        agg.record(KIND_UNANSWERED, "selftest query", ["faq001"])
+        assert agg.flush() == 1
+        print(f"wrote 1 row to {ANALYTICS_TABLE} at {ANALYTICS_ENDPOINT_URL}")
+        return
+
+    stub = _StubDynamoDB(unprocessed_on_first=2)
+    agg = QueryAggregator(DynamoDBSink("Analytics", client=stub), flush_interval=3600)
+    for i in range(60):
+        agg.record(KIND_UNANSWERED, f"query  {i}", ["faq00%d" % (i % 3), "faq009"])
+    agg.record(KIND_UNANSWERED, "query 0", ["faq000"])
+    agg.record(KIND_AMBIGUOUS, "order", ["faq004", "faq006"], tenant="north")
+
+    assert not agg.flush_if_due(), "window is not due yet"
+    assert agg.flush() == 61
+    # 25-item batches, with the 2 rejected items of the first batch retried on their own
+    assert stub.calls == [25, 2, 25, 11], stub.calls
+    assert len(stub.items) == 61
+
+    rows = {item["pk"]["S"]: item for item in stub.items}
+    row = rows["unanswered#query 0"]
+    assert set(row) == {"pk", "sk", "kind", "query", "count", "candidates", "first_seen", "last_seen"}, set(row)
+    assert row["count"] == {"N": "2"}
+    assert row["kind"] == {"S": KIND_UNANSWERED}
+    assert row["candidates"]["L"][0] == {"S": "faq000"}
+    tenant_row = rows["north#ambiguous#order"]
+    assert tenant_row["tenant"] == {"S": "north"}
+    assert tenant_row["sk"]["S"].endswith("#" + agg.instance)
+    assert agg.flush() == 0, "flush drains the window"
+    print(f"batches: sizes {stub.calls}, {len(stub.items)} rows")
+
+    # A deadline stops the flush between batches; the rest waits for the next flush
+    stub = _StubDynamoDB(delay=0.2)
+    agg = QueryAggregator(DynamoDBSink("Analytics", client=stub), flush_interval=3600)
+    for i in range(60):
+        agg.record(KIND_UNANSWERED, f"query {i}", ["faq001"])
+    assert agg.flush(time.monotonic() + FLUSH_MIN_BUDGET_S - 0.1) == 0, "too little time to start"
+    assert stub.calls == []
+    assert agg.flush(time.monotonic() + FLUSH_MIN_BUDGET_S + 0.1) == 25
+    assert stub.calls == [25], stub.calls
+    agg.record(KIND_UNANSWERED, "query 59", ["faq002"])
+    assert agg.flush() == 35
+    assert stub.calls == [25, 25, 10], stub.calls
+    rows = {item["pk"]["S"]: item for item in stub.items}
+    assert len(rows) == 60 and len(stub.items) == 60
+    assert rows["unanswered#query 59"]["count"] == {"N": "2"}, "kept rows merge with new counts"
+    print("deadline: first flush wrote 25 rows, the next wrote the other 35")
+
+    # A failed call keeps its rows too
+    stub = _StubDynamoDB(fail_first=True)
+    agg = QueryAggregator(DynamoDBSink("Analytics", client=stub), flush_interval=3600)
+    agg.record(KIND_AMBIGUOUS, "order", ["faq004"], tenant="north")
+    assert agg.flush() == 0
+    assert agg.flush() == 1 and len(stub.items) == 1
+    assert stub.items[0]["tenant"] == {"S": "north"}
+    print("selftest passed")
+
+if __name__ == "__main__":
+    import sys
+    if "--selftest" in sys.argv:
+        _selftest()
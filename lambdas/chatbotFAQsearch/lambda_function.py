@@ -1,23 +1,73 @@
 import json
 import boto3
+from boto3.dynamodb.types import TypeDeserializer
 import urllib.request
 import urllib.error
 from urllib.parse import parse_qs
-from botocore.exceptions import ClientError
+from botocore.config import Config
+import botocore.loaders
+import botocore.session
+from botocore.exceptions import BotoCoreError, ClientError
 import base64, traceback
 import os
 import uuid
+import threading
+from time import monotonic
 from datetime import datetime, time
 try:
     from zoneinfo import ZoneInfo  # Python 3.9+
 except ImportError:
     ZoneInfo = None
 
+import analytics
+import tenants
+
 # ====== Constants ======
 SECRET_NAME = os.getenv("SECRET_NAME", "FAQSecrets") # fix this
 TABLE_NAME  = os.getenv("TABLE_NAME", "FAQTable")   # fix this
 REGION_NAME = os.getenv("REGION_NAME", "us-east-1") # fix this
 TIME_ZONE   = os.getenv("TIME_ZONE")
+LEX_BOT_ID       = os.getenv("LEX_BOT_ID", "I6UVGIKT8S")
+LEX_BOT_ALIAS_ID = os.getenv("LEX_BOT_ALIAS_ID", "ZQAI6HOQEZ")
+
+# ====== Request budget ======
+# The function timeout is only a few seconds, so every outbound call gets a slice
+# of whatever time the invocation has left instead of botocore/urllib defaults.
+SAFETY_MARGIN_S  = float(os.getenv("SAFETY_MARGIN_S", "0.2"))   # kept back from the Lambda deadline
+REPLY_RESERVE_S  = float(os.getenv("REPLY_RESERVE_S", "0.8"))   # kept back for sending the reply
+LEX_MIN_BUDGET_S = float(os.getenv("LEX_MIN_BUDGET_S", "0.5"))  # below this, skip Lex and answer from FAQ
+TG_TIMEOUT_S     = 10                                           # cap for Telegram sendMessage
+BUDGET_BUCKETS_S = (0.25, 0.5, 1.0, 2.0)                       # timeout sizes of the prebuilt clients;
+MIN_BUDGET_S     = BUDGET_BUCKETS_S[0]                          # budgets below the smallest skip the call
+
+def deadline_from_context(context):
+    """Absolute monotonic deadline for this invocation, or None outside Lambda."""
+    get_remaining = getattr(context, "get_remaining_time_in_millis", None)
+    if not callable(get_remaining):
+        return None
+    return monotonic() + get_remaining() / 1000.0 - SAFETY_MARGIN_S
+
+def time_left(deadline, reserve=0.0):
+    """Seconds left before `deadline` minus `reserve`; None means no deadline."""
+    if deadline is None:
+        return None
+    return deadline - monotonic() - reserve
+
+def _budget_bucket(seconds):
+    """Largest bucket in BUDGET_BUCKETS_S that fits `seconds`, or 0 if none does.
+    Callers must not make the call when the budget is under MIN_BUDGET_S."""
+    fitting = [b for b in BUDGET_BUCKETS_S if b <= seconds]
+    return fitting[-1] if fitting else 0
+
+def budget_config(seconds):
+    """botocore config whose connect + read timeouts fit inside `seconds`, no retries."""
+    connect = min(0.5, seconds / 2)
+    return Config(
+        connect_timeout=connect,
+        read_timeout=seconds - connect,
+        # total_max_attempts counts the first try; plain max_attempts counts retries
+        retries={"total_max_attempts": 1, "mode": "standard"},
+    )
 
 # ====== Secrets (Telegram token) ======
 def get_secret(secret_name, region_name):
@@ -25,7 +75,8 @@ def get_secret(secret_name, region_name):
     try:
         resp = sm.get_secret_value(SecretId=secret_name)
         return json.loads(resp.get("SecretString") or "{}")
-    except ClientError as e:
+    except (ClientError, BotoCoreError) as e:
+        # BotoCoreError covers missing credentials / no network, e.g. offline load tests
         print("SecretsManager error:", repr(e))
         traceback.print_exc()
         return {}
@@ -34,20 +85,78 @@ secrets  = get_secret(SECRET_NAME, REGION_NAME)
 TG_TOKEN = secrets.get("TELEGRAM_BOT_TOKEN")
 
 # ====== AWS ======
-dynamodb = boto3.resource("dynamodb", region_name=REGION_NAME)
-table     = dynamodb.Table(TABLE_NAME)
+# server.py calls lambda_handler from a thread pool, and boto3 sessions,
+# resources and client creation are not thread-safe. So each thread gets its
+# own session and its own low-level clients, one per budget bucket.
+# All of a thread's clients are built in one go by warm_clients(): at import
+# (Lambda init) for the main thread, and before the budget is measured
+# everywhere else, so client construction never eats into a measured budget.
+# The sessions share one data loader, so the service models are parsed once
+# per process rather than once per thread.
+AWS_SERVICES = ("dynamodb", "lexv2-runtime")
+_local = threading.local()
+_loader = botocore.loaders.create_loader()
+_deserializer = TypeDeserializer()
+
+def warm_clients():
+    """Build this thread's session and every (service, bucket) client, once."""
+    if getattr(_local, "clients", None) is not None:
+        return
+    core = botocore.session.get_session()
+    core.register_component("data_loader", _loader)
+    session = boto3.session.Session(botocore_session=core, region_name=REGION_NAME)
+    clients = {}
+    for service in AWS_SERVICES:
+        clients[(service, None)] = session.client(service)
+        for bucket in BUDGET_BUCKETS_S:
+            clients[(service, bucket)] = session.client(service, config=budget_config(bucket))
+    _local.session, _local.clients = session, clients
+
+def _client(service, budget):
+    """This thread's `service` client whose timeouts fit `budget` seconds (defaults if None)."""
+    warm_clients()
+    bucket = None if budget is None else _budget_bucket(budget)
+    return _local.clients[(service, bucket)]
+
+def dynamodb_client_for(budget):
+    return _client("dynamodb", budget)
 
 # ====== Lex Bot  ======
-lex_client = boto3.client('lexv2-runtime', region_name=REGION_NAME)
-
-def send_to_lex(user_text: str, session_id: str):
+def lex_client_for(budget):
+    return _client("lexv2-runtime", budget)
+
+def reset_clients():
+    """Drop every cached session and client, e.g. in a worker process after fork."""
+    global _local
+    _local = threading.local()
+
+warm_clients()
+
+def _lex_unhandled(intent, state):
+    """Result for when Lex was skipped or failed, i.e. never saw the text."""
+    return {
+        "reply": None,
+        "handled": False,
+        "responded": False,
+        "intent": intent,
+        "state": state,
+        "session_attributes": {}
+    }
+
+def send_to_lex(user_text: str, session_id: str, deadline=None, tenant=None):
     """Enhanced Lex integration with proper fallback detection"""
+    tenant = tenant or DEFAULT_TENANT
+    warm_clients()   # before measuring, so a first-use build is not charged to the call
+    budget = time_left(deadline, REPLY_RESERVE_S)
+    if budget is not None and budget < LEX_MIN_BUDGET_S:
+        print(f"Skipping Lex, only {budget:.2f}s of budget left")
+        return _lex_unhandled("Skipped", "NoBudget")
     try:
         print(f"Sending to Lex: {user_text}")
         
-        response = lex_client.recognize_text(
-            botId="I6UVGIKT8S",
-            botAliasId="ZQAI6HOQEZ", 
+        response = lex_client_for(budget).recognize_text(
+            botId=tenant.bot_id,
+            botAliasId=tenant.bot_alias_id,
             localeId="en_US",
             sessionId=session_id,
             text=user_text
@@ -78,6 +187,7 @@ def send_to_lex(user_text: str, session_id: str):
         return {
             "reply": reply,
             "handled": lex_handled,
+            "responded": True,
             "intent": intent_name,
             "state": intent_state,
             "session_attributes": session_attributes
@@ -86,13 +196,7 @@ def send_to_lex(user_text: str, session_id: str):
     except Exception as e:
         print(f"Lex error: {str(e)}")
         traceback.print_exc()
-        return {
-            "reply": None,
-            "handled": False,
-            "intent": "Error",
-            "state": "Failed",
-            "session_attributes": {}
-        }
+        return _lex_unhandled("Error", "Failed")
 def should_try_lex(user_text):
     """
     More conservative approach - only try Lex for specific cases
@@ -171,25 +275,42 @@ def is_lex_handled_successfully(intent_name, intent_state, reply, session_attrib
 # ====== FAQ cache ======
 FAQ_CACHE = None
 
-def fetch_all():
+def fetch_all(deadline=None, table_name=TABLE_NAME):
+    """Scan the whole FAQ table. Returns None if the scan failed or ran out of time."""
     items = []
+    scan_kwargs = {}
+    warm_clients()   # before measuring, so a first-use build is not charged to the scan
     try:
-        resp = table.scan()
-        items.extend(resp.get("Items", []))
-        while "LastEvaluatedKey" in resp:
-            resp = table.scan(ExclusiveStartKey=resp["LastEvaluatedKey"])
-            items.extend(resp.get("Items", []))
+        while True:
+            budget = time_left(deadline, REPLY_RESERVE_S)
+            if budget is not None and budget < MIN_BUDGET_S:
+                print("DynamoDB scan stopped: out of request budget")
+                return None
+            resp = dynamodb_client_for(budget).scan(TableName=table_name, **scan_kwargs)
+            items.extend({k: _deserializer.deserialize(v) for k, v in it.items()}
+                         for it in resp.get("Items", []))
+            if "LastEvaluatedKey" not in resp:
+                return items
+            scan_kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
     except Exception as e:
         print("DynamoDB scan error:", repr(e))
         traceback.print_exc()
-    return items
+        return None
 
-def get_faqs():
+def get_faqs(deadline=None, tenant=None):
     global FAQ_CACHE
+    if tenant is not None and tenant is not DEFAULT_TENANT:
+        # Other tenants share a memory-budgeted LRU instead of a pinned global.
+        # Waiting on another request's load must still leave time to reply.
+        wait = time_left(deadline, REPLY_RESERVE_S)
+        items = TENANT_INDEXES.get(tenant.id, lambda: fetch_all(deadline, tenant.table),
+                                   timeout=None if wait is None else max(wait, 0))
+        return items or []
     if FAQ_CACHE is None:
-        FAQ_CACHE = fetch_all()
+        # Only cache complete scans so a timed-out cold start retries next time
+        FAQ_CACHE = fetch_all(deadline)
         # print("This is FAQ " + FAQ_CACHE)
-    return FAQ_CACHE
+    return FAQ_CACHE or []
 
 
 # ====== Hours helpers (dynamic “today/now”) ======
@@ -203,9 +324,9 @@ WEEKLY_HOURS = {
     6: (time(10, 0), time(19, 0)),   # Sunday
 }
 
-def _now_local():
+def _now_local(time_zone=TIME_ZONE):
     if ZoneInfo:
-        return datetime.now(ZoneInfo(TIME_ZONE))
+        return datetime.now(ZoneInfo(time_zone))
     return datetime.utcnow()
 
 def _fmt_t(t: time) -> str:
@@ -217,10 +338,11 @@ def _fmt_t(t: time) -> str:
         s = dt.strftime("%I:%M %p")
         return s.lstrip("0") if s.startswith("0") else s
 
-def hours_message_for_today():
-    now = _now_local()
+def hours_message_for_today(tenant=None):
+    tenant = tenant or DEFAULT_TENANT
+    now = _now_local(tenant.time_zone)
     day_idx = now.weekday()
-    hours = WEEKLY_HOURS.get(day_idx)
+    hours = tenant.weekly_hours.get(day_idx)
     day_name = now.strftime("%A")
     if not hours:
         return f"Sorry.. We’re closed today ({day_name})."
@@ -236,6 +358,25 @@ def hours_message_for_today():
     else:
         return f"We’re open now until {_fmt_t(close_t)}."
 
+# ====== Tenants ======
+DEFAULT_TENANT = tenants.Tenant(
+    tenants.DEFAULT_TENANT_ID,
+    table=TABLE_NAME,
+    bot_id=LEX_BOT_ID,
+    bot_alias_id=LEX_BOT_ALIAS_ID,
+    weekly_hours=WEEKLY_HOURS,
+    time_zone=TIME_ZONE,
+    telegram_token=TG_TOKEN,
+)
+TENANTS        = tenants.TenantRegistry.from_config(tenants.TENANTS_CONFIG, DEFAULT_TENANT, secrets)
+TENANT_INDEXES = tenants.TenantIndexCache()
+
+def tenant_tag(tenant):
+    """Tenant id for analytics rows; None keeps single-tenant rows unprefixed."""
+    if tenant is None or tenant is DEFAULT_TENANT:
+        return None
+    return tenant.id
+
 def looks_like_today_hours(q: str) -> bool:
     ql = (q or "").lower()
     hints_any = any(w in ql for w in ["today", "now", "open now", "close now", "closing", "closing time", "Right Now"])
@@ -320,7 +461,7 @@ def score_item(item, query):
 # ---- matching knobs ----
 MIN_OVERLAP  = 2      # require at least 2 content-word overlaps (unless exact/substring)
 TIE_DELTA    = 1      # if top2 overlaps differ by <= 1 and not exact, ask to rephrase
-LOG_MATCHING = True   # set False to silence logs
+LOG_MATCHING = os.getenv("LOG_MATCHING", "false").lower() == "true"   # per-request match logs; misses go to analytics
 
 # Group the most common intent words users type.
 INTENT_GROUPS = [
@@ -389,14 +530,18 @@ def score_item(item, query):
     es, ov, ln = _score_tuple(qn, hn, overlap, len(hay_raw))
     return (es, ov, ln, hay_raw)          # keep raw for logging
 
-def best_answer(user_text: str) -> str:
+def faq_ident(item):
+    return item.get("id") or item.get("category") or item.get("question", "")[:60]
+
+def best_answer(user_text: str, deadline=None, tenant=None) -> str:
     query = (user_text or "").strip()
     if not query:
         return "Hi! Ask me about opening hours, delivery, or returns."
 
-    faqs = get_faqs()
-    print("Our FAQs")
-    print(faqs)
+    faqs = get_faqs(deadline, tenant)
+    if LOG_MATCHING:
+        print("Our FAQs")
+        print(faqs)
     if not faqs:
         return "Sorry, I don’t have any FAQs yet."
 
@@ -406,13 +551,19 @@ def best_answer(user_text: str) -> str:
 
     # Score candidates
     scored = []
+    near_misses = []
     for it in faqs:
         es, ov, ln, raw = score_item(it, query)
         # allow exact/substring even if overlap is small
         if ov >= MIN_OVERLAP or es > 0:
             scored.append(((es, ov, ln), it, raw))
+        elif ov:
+            near_misses.append((ov, it))
 
     if not scored:
+        near_misses.sort(key=lambda x: x[0], reverse=True)
+        analytics.record(analytics.KIND_UNANSWERED, normalize(query),
+                         [faq_ident(it) for _, it in near_misses[:3]], tenant_tag(tenant))
         return "Sorry, I couldn’t find that. Try: returns, delivery, or opening hours."
 
     # Sort by (exact/substring, overlap, length)
@@ -422,8 +573,7 @@ def best_answer(user_text: str) -> str:
     if LOG_MATCHING:
         print("QUERY:", query)
         for rank, (sc, it, raw) in enumerate(scored[:5], 1):
-            ident = it.get("id") or it.get("category") or it.get("question", "")[:60]
-            print(f"  #{rank} score={sc} id={ident!r} sampleQ={raw[:80]!r}")
+            print(f"  #{rank} score={sc} id={faq_ident(it)!r} sampleQ={raw[:80]!r}")
 
     # Tie-handling: if top2 are very close and not exact, ask user to clarify
     top = scored[0]
@@ -437,6 +587,8 @@ def best_answer(user_text: str) -> str:
                 if label:
                     options.append(f"“{label}”")
             opts = " or ".join(options)
+            analytics.record(analytics.KIND_AMBIGUOUS, normalize(query),
+                             [faq_ident(it) for _, it, _ in scored[:3]], tenant_tag(tenant))
             return f"Did you mean {opts}? (Please rephrase.)"
 
     # Confident winner
@@ -449,7 +601,7 @@ def best_answer(user_text: str) -> str:
     #if user_text and looks_like_today_hours(user_text):
      #   return hours_message_for_today()
     #return best_answer(user_text)
-def choose_reply(user_text: str, chat_id: str = None) -> str:
+def choose_reply(user_text: str, chat_id: str = None, deadline=None, tenant=None) -> str:
     """Enhanced reply logic with proper Lex-FAQ integration"""
     if not user_text or not user_text.strip():
         return "Hi! Ask me about opening hours, delivery, or returns."
@@ -457,13 +609,13 @@ def choose_reply(user_text: str, chat_id: str = None) -> str:
     # Handle hours queries directly with FAQ (faster than Lex)
     if looks_like_today_hours(user_text):
         print("Detected hours query - using direct FAQ response")
-        return hours_message_for_today()
+        return hours_message_for_today(tenant)
     
     # Determine if we should try Lex
     if chat_id and should_try_lex(user_text):
         print("Query matches Lex criteria, trying Lex first...")
         
-        lex_response = send_to_lex(user_text, chat_id)
+        lex_response = send_to_lex(user_text, chat_id, deadline, tenant)
         
         if lex_response["handled"]:
             print(f"✅ Lex handled successfully: {lex_response['intent']}")
@@ -471,25 +623,34 @@ def choose_reply(user_text: str, chat_id: str = None) -> str:
         else:
             print(f"❌ Lex didn't handle (Intent: {lex_response['intent']}, State: {lex_response['state']})")
             print("Falling back to FAQ system...")
+            # Skips (no budget) and errors are outages, not gaps in what Lex understands
+            if lex_response["responded"]:
+                analytics.record(analytics.KIND_LEX_FALLBACK, normalize(user_text), [lex_response["intent"]],
+                                 tenant_tag(tenant))
     else:
         print("Query doesn't match Lex criteria, using FAQ directly")
     
     # Use FAQ system as fallback or primary
     print("Using FAQ system")
-    return best_answer(user_text)
+    return best_answer(user_text, deadline, tenant)
 
 # ====== Telegram send ======
-def tg_send(chat_id: int, text: str, token: str):
+def tg_send(chat_id: int, text: str, token: str, deadline=None):
     if not chat_id or not token:
         print("Missing chat_id or token:", chat_id, bool(token))
         return
+    timeout = TG_TIMEOUT_S
+    budget = time_left(deadline)
+    if budget is not None:
+        # Still try when nearly out of time; a short send beats no reply at all
+        timeout = max(min(timeout, budget), MIN_BUDGET_S)
     url = f"https://api.telegram.org/bot{token}/sendMessage"
     payload = {"chat_id": chat_id, "text": text}
     data = json.dumps(payload).encode("utf-8")
     req = urllib.request.Request(url, data=data, method="POST")
     req.add_header("Content-Type", "application/json")
     try:
-        with urllib.request.urlopen(req, timeout=10) as resp:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
             resp.read()
     except urllib.error.HTTPError as e:
         print("Telegram HTTP error:", e.read().decode("utf-8", "ignore"))
@@ -521,32 +682,102 @@ def extract_message(payload):
     user_text = msg.get("text", "")
     return chat_id, user_text
 
-def handle_form_encoded(raw_body):
+def handle_form_encoded(raw_body, deadline=None, tenant=None):
     form = parse_qs(raw_body)
     user_text = form.get("Body", [""])[0] or form.get("message", [""])[0]
-    reply = choose_reply(user_text)
+    reply = choose_reply(user_text, deadline=deadline, tenant=tenant)
     twiml = f'<?xml version="1.0" encoding="UTF-8"?><Response><Message>{reply}</Message></Response>'
     return {"statusCode": 200, "headers": {"Content-Type": "text/xml"}, "body": twiml}
 
 # ====== Handler ======
 def lambda_handler(event, context):
+    deadline = deadline_from_context(context)
+    tenant = TENANTS.resolve(event)
+    if tenant is None:
+        return {"statusCode": 404, "headers": {"Content-Type": "application/json"},
+                "body": json.dumps({"error": "Unknown tenant"})}
     payload, content_type, raw_body = parse_event_body(event)
     chat_id, user_text = extract_message(payload)
 
     # Telegram webhook
     if chat_id:      
         #reply = choose_reply(user_text)          # <-- DO NOT overwrite later
-        reply = choose_reply(user_text, str(chat_id))  # Pass chat_id for Lex session
-        tg_send(chat_id, reply, TG_TOKEN)
+        reply = choose_reply(user_text, str(chat_id), deadline, tenant)  # Pass chat_id for Lex session
+        tg_send(chat_id, reply, tenant.telegram_token, deadline)
+        # Reply already delivered; the flush stops short of the deadline
+        analytics.aggregator.flush_if_due(deadline)
         return {"statusCode": 200, "headers": {"Content-Type": "application/json"},
                 "body": json.dumps({"status": "ok"})}
 
     # Twilio-style form posts
     if "application/x-www-form-urlencoded" in content_type:
-        return handle_form_encoded(raw_body)
+        return handle_form_encoded(raw_body, deadline, tenant)
 
     # Fallback: plain JSON { "message": "..." } for console/tests
     user_text = user_text or payload.get("message", "")
-    reply = choose_reply(user_text)
+    reply = choose_reply(user_text, deadline=deadline, tenant=tenant)
     return {"statusCode": 200, "headers": {"Content-Type": "application/json"},
             "body": json.dumps({"reply": reply})}
+
+
+# ====== Budget check ======
+def _budget_check():
+    """
+    Point budgeted Lex/DynamoDB clients at a socket that accepts connections
+    and never answers, and assert each call gives up inside its budget
+    (i.e. no hidden retry). Needs no AWS access.
+    """
+    import socket
+    import threading
+
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(16)
+    held = []
+    def accept_forever():
+        while True:
+            conn, _ = listener.accept()
+            held.append(conn)   # keep it open, never reply
+    threading.Thread(target=accept_forever, daemon=True).start()
+    endpoint = "http://127.0.0.1:%d" % listener.getsockname()[1]
+
+    assert _budget_bucket(0.2) == 0, "budgets under one step must not round up"
+    assert _budget_bucket(1.37) == 1.0
+    assert _budget_bucket(9) == BUDGET_BUCKETS_S[-1]
+
+    # Every bucket's client exists before any budget is measured
+    warm_clients()
+    built = dict(_local.clients)
+    start = monotonic()
+    for service in AWS_SERVICES:
+        for b in (None,) + BUDGET_BUCKETS_S:
+            assert _client(service, b) is built[(service, b)]
+    assert monotonic() - start < 0.01, "client lookup must not build clients"
+
+    budget = BUDGET_BUCKETS_S[2]
+    calls = {
+        "lex": lambda: boto3.client("lexv2-runtime", region_name=REGION_NAME, endpoint_url=endpoint,
+                                    config=budget_config(budget)).recognize_text(
+            botId=LEX_BOT_ID, botAliasId=LEX_BOT_ALIAS_ID, localeId="en_US", sessionId="check", text="hi"),
+        "dynamodb": lambda: boto3.client("dynamodb", region_name=REGION_NAME, endpoint_url=endpoint,
+                                         config=budget_config(budget)).scan(TableName=TABLE_NAME),
+    }
+    for name, call in calls.items():
+        start = monotonic()
+        try:
+            call()
+        except Exception:
+            pass
+        elapsed = monotonic() - start
+        print(f"{name}: gave up after {elapsed:.2f}s with a {budget:.2f}s budget")
+        assert elapsed < budget + 0.2, f"{name} call overran its budget ({elapsed:.2f}s)"
+
+    start = monotonic()
+    assert fetch_all(monotonic() + REPLY_RESERVE_S + MIN_BUDGET_S / 2) is None
+    assert monotonic() - start < 0.05, "fetch_all should not scan with less than one step left"
+    print("budget check passed")
+
+if __name__ == "__main__":
+    import sys
+    if "--budget-check" in sys.argv:
+        _budget_check()
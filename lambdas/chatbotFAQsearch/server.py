@@ -0,0 +1,408 @@
+"""
+Long-running server mode for chatbotFAQsearch.
+
+Serves the same /faq and /telegram routes as template.yml (including the
+per-tenant /faq/<tenant> and /telegram/<tenant> forms), but from a
+container instead of Lambda. The parent process preloads the FAQ index and
+binds the listening socket, then forks one asyncio worker per core; workers
+share the index copy-on-write and run every request through
+lambda_function.lambda_handler (parse_event_body -> choose_reply).
+
+    python server.py --port 8080                 # serve
+    python server.py --faq-file ../../DynamoDB/ChatbotFAQ.json
+    python server.py --load-test --duration 5    # throughput vs. worker count
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+import analytics
+import lambda_function as lf
+
+# ====== Constants ======
+ROUTES            = {"/faq", "/telegram"}
+REQUEST_TIMEOUT_S = float(os.getenv("REQUEST_TIMEOUT_S", "3"))   # same budget as the Lambda Timeout
+SHUTDOWN_GRACE_S  = float(os.getenv("SHUTDOWN_GRACE_S", "10"))   # wait this long for in-flight requests
+WORKER_THREADS    = int(os.getenv("WORKER_THREADS", "8"))        # blocking Lex/DynamoDB/Telegram calls per worker
+MAX_BODY_BYTES    = 1024 * 1024
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large",
+           500: "Internal Server Error"}
+
+
+# ====== FAQ index ======
+def load_faq_file(path):
+    """Read a DynamoDB JSON export ({"Items": [...]}) into plain FAQ items."""
+    from boto3.dynamodb.types import TypeDeserializer
+    deserializer = TypeDeserializer()
+    with open(path, encoding="utf-8") as f:
+        export = json.load(f)
+    return [{k: deserializer.deserialize(v) for k, v in item.items()}
+            for item in export.get("Items", [])]
+
+def preload_faqs(faq_file=None):
+    """Fill lambda_function's FAQ cache before forking so workers share it."""
+    if faq_file:
+        lf.FAQ_CACHE = load_faq_file(faq_file)
+    faqs = lf.get_faqs()
+    print(f"Preloaded {len(faqs)} FAQ items")
+    return faqs
+
+
+# ====== Request context ======
+class RequestContext:
+    """Minimal stand-in for the Lambda context, so request deadlines still apply."""
+    def __init__(self, timeout_s=REQUEST_TIMEOUT_S):
+        self._deadline = monotonic() + timeout_s
+
+    def get_remaining_time_in_millis(self):
+        return max(int((self._deadline - monotonic()) * 1000), 0)
+
+
+# ====== HTTP ======
+class HttpError(Exception):
+    def __init__(self, status):
+        super().__init__(REASONS.get(status, ""))
+        self.status = status
+
+async def read_request(reader):
+    """Read one HTTP/1.1 request. Returns None when the client closed the connection."""
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError as e:
+        if e.partial.strip():
+            raise HttpError(400)
+        return None
+    except asyncio.LimitOverrunError:
+        raise HttpError(400)
+
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, target, version = lines[0].split(" ", 2)
+    except ValueError:
+        raise HttpError(400)
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            k, v = line.split(":", 1)
+            headers[k.strip()] = v.strip()
+    lower = {k.lower(): v for k, v in headers.items()}
+
+    if "chunked" in lower.get("transfer-encoding", "").lower():
+        raise HttpError(400)
+    try:
+        length = int(lower.get("content-length") or 0)
+    except ValueError:
+        raise HttpError(400)
+    if length < 0:
+        raise HttpError(400)
+    if length > MAX_BODY_BYTES:
+        raise HttpError(413)
+    body = await reader.readexactly(length) if length else b""
+
+    keep_alive = lower.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+    return {
+        "httpMethod": method,
+        "path": target.split("?", 1)[0],
+        "headers": headers,
+        "body": body.decode("utf-8", "replace"),
+        "isBase64Encoded": False,
+    }, keep_alive
+
+def write_response(writer, status, headers, body, keep_alive):
+    data = body.encode("utf-8") if isinstance(body, str) else (body or b"")
+    lines = [f"HTTP/1.1 {status} {REASONS.get(status, 'OK')}"]
+    for k, v in (headers or {}).items():
+        lines.append(f"{k}: {v}")
+    lines.append(f"Content-Length: {len(data)}")
+    lines.append("Connection: " + ("keep-alive" if keep_alive else "close"))
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + data)
+
+def json_error(status):
+    return {"statusCode": status, "headers": {"Content-Type": "application/json"},
+            "body": json.dumps({"error": REASONS.get(status, "")})}
+
+
+# ====== Worker ======
+class Worker:
+    """One asyncio event loop serving the shared listening socket."""
+    def __init__(self, sock, threads=WORKER_THREADS):
+        self.sock = sock
+        self.threads = threads
+        # Build each pool thread's boto3 clients up front, not inside a request budget
+        self.executor = ThreadPoolExecutor(max_workers=threads, initializer=lf.warm_clients)
+        self.connections = {}   # task -> True while a request is in flight
+        self.stopping = False
+
+    async def dispatch(self, event):
+        path = event["path"]
+        if not any(path == r or path.startswith(r + "/") for r in ROUTES):
+            return json_error(404)
+        loop = asyncio.get_running_loop()
+        try:
+            # lambda_handler blocks on Lex/DynamoDB/Telegram, so keep it off the loop
+            return await loop.run_in_executor(self.executor, lf.lambda_handler, event, RequestContext())
+        except Exception as e:
+            print("Handler error:", repr(e))
+            traceback.print_exc()
+            return json_error(500)
+
+    async def handle(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections[task] = False
+        try:
+            while not self.stopping:
+                try:
+                    request = await read_request(reader)
+                except HttpError as e:
+                    resp = json_error(e.status)
+                    write_response(writer, resp["statusCode"], resp["headers"], resp["body"], False)
+                    break
+                if request is None:
+                    break
+                event, keep_alive = request
+                self.connections[task] = True
+                resp = await self.dispatch(event)
+                keep_alive = keep_alive and not self.stopping
+                write_response(writer, resp.get("statusCode", 200), resp.get("headers"),
+                               resp.get("body", ""), keep_alive)
+                await writer.drain()
+                self.connections[task] = False
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.connections.pop(task, None)
+            writer.close()
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+
+        # Start every pool thread (and so warm its clients) before taking requests;
+        # the barrier keeps one task per thread
+        barrier = threading.Barrier(self.threads)
+        await asyncio.gather(*(loop.run_in_executor(self.executor, barrier.wait)
+                               for _ in range(self.threads)))
+        server = await asyncio.start_server(self.handle, sock=self.sock)
+        await stop.wait()
+
+        # Graceful shutdown: stop accepting, drop idle keep-alive connections,
+        # give in-flight requests SHUTDOWN_GRACE_S to finish.
+        self.stopping = True
+        server.close()
+        for task, busy in list(self.connections.items()):
+            if not busy:
+                task.cancel()
+        pending = list(self.connections)
+        if pending:
+            _, still_running = await asyncio.wait(pending, timeout=SHUTDOWN_GRACE_S)
+            for task in still_running:
+                task.cancel()
+        self.executor.shutdown(wait=False)
+
+def run_worker(sock, quiet=False):
+    if quiet:
+        # lambda_function logs every request; too much for a busy container
+        sys.stdout = open(os.devnull, "w")
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    lf.reset_clients()   # boto3 connection pools must not be shared across fork
+    asyncio.run(Worker(sock).serve())
+    # multiprocessing children leave through os._exit, so atexit never flushes
+    analytics.aggregator.flush()
+
+
+# ====== Supervisor ======
+def bind_socket(host, port, backlog=1024):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+def serve(sock, workers, quiet=False):
+    """Fork `workers` processes on `sock` and wait; SIGTERM/SIGINT drains them."""
+    ctx = multiprocessing.get_context("fork")
+    procs = [ctx.Process(target=run_worker, args=(sock, quiet), daemon=False) for _ in range(workers)]
+    for p in procs:
+        p.start()
+
+    def forward(signum, frame):
+        for p in procs:
+            if p.is_alive():
+                os.kill(p.pid, signal.SIGTERM)
+    previous = {sig: signal.signal(sig, forward) for sig in (signal.SIGTERM, signal.SIGINT)}
+    try:
+        for p in procs:
+            p.join()
+    finally:
+        for sig, handler in previous.items():
+            signal.signal(sig, handler)
+    return [p.exitcode for p in procs]
+
+
+# ====== Load test ======
+LOAD_QUERIES = [
+    "What are your store hours?",
+    "Can I return an item?",
+    "Do you offer delivery?",
+    "Do you have any coupons or promo codes?",
+    "Which payment methods do you accept?",
+    "Do you sell halal food?",
+    "something the FAQ does not cover",
+]
+
+async def _load_request(reader, writer, query):
+    body = json.dumps({"message": query}).encode("utf-8")
+    writer.write(b"POST /faq HTTP/1.1\r\nHost: load\r\nContent-Type: application/json\r\n"
+                 b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+    head = await reader.readuntil(b"\r\n\r\n")
+    length = 0
+    for line in head.split(b"\r\n"):
+        if line.lower().startswith(b"content-length:"):
+            length = int(line.split(b":", 1)[1])
+    await reader.readexactly(length)
+
+async def _load_connection(reader, writer, until, latencies):
+    i = 0
+    try:
+        while monotonic() < until:
+            start = monotonic()
+            await _load_request(reader, writer, LOAD_QUERIES[i % len(LOAD_QUERIES)])
+            i += 1
+            latencies.append(monotonic() - start)
+    finally:
+        writer.close()
+
+def _load_client(host, port, connections, duration, results, cores=None):
+    _pin(cores)
+    async def run():
+        conns = await asyncio.gather(*(asyncio.open_connection(host, port) for _ in range(connections)))
+        # One untimed request per connection, so worker start-up isn't measured
+        await asyncio.gather(*(_load_request(r, w, LOAD_QUERIES[0]) for r, w in conns))
+        latencies = []
+        until = monotonic() + duration
+        await asyncio.gather(*(_load_connection(r, w, until, latencies) for r, w in conns))
+        return latencies
+    results.put(asyncio.run(run()))
+
+def _split_cores(clients):
+    """Split the usable CPUs into (server cores, client cores); both are all of them on one CPU."""
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    if len(cores) < 2:
+        return cores, cores
+    n = min(clients, len(cores) - 1)
+    return cores[n:], cores[:n]
+
+def _pin(cores):
+    """Restrict this process (and what it forks) to `cores`, where the OS allows it."""
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+
+def _serve_pinned(sock, workers, cores):
+    _pin(cores)
+    serve(sock, workers, True)
+
+def load_test(workers_list, duration, connections, clients):
+    """
+    Run the /faq route under a fixed client load for each worker count. Client
+    processes and server workers are pinned to separate cores, and worker
+    counts are capped at the server's share, so clients don't eat into the
+    CPU being measured.
+    """
+    ctx = multiprocessing.get_context("fork")
+    server_cores, client_cores = _split_cores(clients)
+    pinned = hasattr(os, "sched_setaffinity")
+    if server_cores == client_cores:
+        print(f"Only {len(server_cores)} core: clients share it with the workers, so scaling is understated")
+    else:
+        workers_list = sorted({min(w, len(server_cores)) for w in workers_list})
+        print(f"Server: {len(server_cores)} cores {server_cores}, clients: {len(client_cores)} cores {client_cores}"
+              f"{'' if pinned else ' (not pinned on this OS)'}; workers capped at {len(server_cores)}")
+    rows = []
+    for workers in workers_list:
+        sock = bind_socket("127.0.0.1", 0)
+        host, port = sock.getsockname()
+        server = ctx.Process(target=_serve_pinned, args=(sock, workers, server_cores))
+        server.start()
+        sock.close()
+
+        results = ctx.Queue()
+        per_client = max(connections // clients, 1)
+        procs = [ctx.Process(target=_load_client, args=(host, port, per_client, duration, results, client_cores))
+                 for _ in range(clients)]
+        for p in procs:
+            p.start()
+        latencies = []
+        for _ in procs:
+            latencies.extend(results.get())
+        for p in procs:
+            p.join()
+
+        os.kill(server.pid, signal.SIGTERM)
+        server.join()
+
+        latencies.sort()
+        n = len(latencies)
+        rps = n / duration
+        p50 = latencies[n // 2] * 1000 if n else 0.0
+        p99 = latencies[min(int(n * 0.99), n - 1)] * 1000 if n else 0.0
+        rows.append((workers, n, rps, p50, p99))
+
+    base = rows[0][2] or 1.0
+    print(f"{'workers':>7} {'requests':>9} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'speedup':>8}")
+    for workers, n, rps, p50, p99 in rows:
+        print(f"{workers:>7} {n:>9} {rps:>9.1f} {p50:>8.2f} {p99:>8.2f} {rps / base:>7.2f}x")
+    return rows
+
+
+# ====== CLI ======
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve chatbotFAQsearch outside Lambda.")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8080")))
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--faq-file", help="DynamoDB JSON export to load instead of scanning TABLE_NAME")
+    parser.add_argument("--quiet", action="store_true", help="silence per-request logging in workers")
+    parser.add_argument("--load-test", action="store_true", help="measure throughput for 1..--workers workers")
+    parser.add_argument("--duration", type=float, default=5.0, help="load test seconds per worker count")
+    parser.add_argument("--connections", type=int, default=64, help="load test keep-alive connections")
+    parser.add_argument("--clients", type=int, default=max((os.cpu_count() or 1) // 2, 1),
+                        help="load test client processes")
+    args = parser.parse_args(argv)
+
+    preload_faqs(args.faq_file)
+
+    if args.load_test:
+        counts, n = [], 1
+        while n < args.workers:
+            counts.append(n)
+            n *= 2
+        counts.append(args.workers)
+        load_test(counts, args.duration, args.connections, args.clients)
+        return 0
+
+    sock = bind_socket(args.host, args.port)
+    print(f"Serving {sorted(ROUTES)} on {args.host}:{args.port} with {args.workers} workers")
+    serve(sock, args.workers, args.quiet)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
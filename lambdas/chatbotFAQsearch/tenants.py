@@ -0,0 +1,319 @@
+"""
+Multi-tenant routing for chatbotFAQsearch.
+
+One deployment can serve several storefronts. Each tenant has its own FAQ
+table, Lex bot, opening hours and Telegram bot token. Requests are routed by
+webhook path (/faq/<tenant>, /telegram/<tenant> or /telegram/<bot token>) or
+by Telegram's X-Telegram-Bot-Api-Secret-Token header. Requests to plain /faq
+and /telegram go to the default tenant, which uses the process-wide settings.
+
+TENANTS_CONFIG is a JSON file path or an inline JSON document:
+
+    {"tenants": {
+        "northside": {
+            "table": "ChatbotFAQ-northside",
+            "bot_id": "ABCDEFGHIJ", "bot_alias_id": "KLMNOPQRST",
+            "time_zone": "Asia/Kuala_Lumpur",
+            "weekly_hours": {"0": ["09:00", "21:00"], "6": null},
+            "token_key": "TELEGRAM_BOT_TOKEN_NORTHSIDE",
+            "webhook_secret": "..."
+        }}}
+
+Weekdays left out of weekly_hours use the default tenant's hours; null means
+closed. token_key names the key in the shared Secrets Manager secret. The
+Lambda role needs dynamodb:Scan on every tenant table (template.yml allows it
+on all tables).
+
+Loaded FAQ indexes are kept in TenantIndexCache, an LRU bounded by an
+estimated byte size rather than an entry count.
+
+    python tenants.py --bench    # hot-tenant vs long-tail cache behaviour
+"""
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from datetime import time
+
+# ====== Constants ======
+TENANTS_CONFIG     = os.getenv("TENANTS_CONFIG")
+TENANT_CACHE_BYTES = int(os.getenv("TENANT_CACHE_BYTES", str(16 * 1024 * 1024)))
+DEFAULT_TENANT_ID  = "default"
+ROUTE_PREFIXES     = ("faq", "telegram")
+SECRET_HEADER      = "x-telegram-bot-api-secret-token"
+
+
+# ====== Tenants ======
+class Tenant:
+    """Per-storefront settings that used to be module constants."""
+    def __init__(self, tenant_id, table, bot_id, bot_alias_id, weekly_hours, time_zone=None,
+                 telegram_token=None, webhook_secret=None):
+        self.id = tenant_id
+        self.table = table
+        self.bot_id = bot_id
+        self.bot_alias_id = bot_alias_id
+        self.weekly_hours = weekly_hours
+        self.time_zone = time_zone
+        self.telegram_token = telegram_token
+        self.webhook_secret = webhook_secret
+
+    def __repr__(self):
+        return f"Tenant({self.id!r}, table={self.table!r})"
+
+def _parse_hours(spec, fallback):
+    hours = dict(fallback)
+    for day, span in (spec or {}).items():
+        day = int(day)
+        if span is None:
+            hours[day] = None
+        else:
+            open_t, close_t = (time.fromisoformat(t) for t in span)
+            hours[day] = (open_t, close_t)
+    return hours
+
+def _read_config(config):
+    if not config:
+        return {}
+    text = config
+    if not config.lstrip().startswith("{"):
+        with open(config, encoding="utf-8") as f:
+            text = f.read()
+    return json.loads(text).get("tenants", {})
+
+
+class TenantRegistry:
+    def __init__(self, default, tenants=()):
+        self.default = default
+        self.by_id = {t.id: t for t in tenants}
+        self.by_id.setdefault(default.id, default)
+        self.by_token = {t.telegram_token: t for t in self.by_id.values() if t.telegram_token}
+        self.by_secret = {t.webhook_secret: t for t in self.by_id.values() if t.webhook_secret}
+
+    @classmethod
+    def from_config(cls, config, default, secrets=None):
+        """Build tenants from TENANTS_CONFIG; tokens are looked up in `secrets`."""
+        secrets = secrets or {}
+        tenants = []
+        for tenant_id, spec in _read_config(config).items():
+            tenants.append(Tenant(
+                tenant_id,
+                table=spec.get("table", default.table),
+                bot_id=spec.get("bot_id", default.bot_id),
+                bot_alias_id=spec.get("bot_alias_id", default.bot_alias_id),
+                weekly_hours=_parse_hours(spec.get("weekly_hours"), default.weekly_hours),
+                time_zone=spec.get("time_zone", default.time_zone),
+                telegram_token=secrets.get(spec.get("token_key") or f"TELEGRAM_BOT_TOKEN_{tenant_id.upper()}"),
+                webhook_secret=spec.get("webhook_secret"),
+            ))
+        return cls(default, tenants)
+
+    def resolve(self, event):
+        """Tenant for an API Gateway event, or None if it names an unknown tenant."""
+        headers = {(k or "").lower(): v for k, v in (event.get("headers") or {}).items()}
+        secret = headers.get(SECRET_HEADER)
+        if secret and secret in self.by_secret:
+            return self.by_secret[secret]
+
+        key = (event.get("pathParameters") or {}).get("tenant")
+        if not key:
+            path = event.get("path") or event.get("rawPath") or ""
+            segments = [s for s in path.split("/") if s]
+            # Stage names and custom base paths can sit in front of the route
+            for i, seg in enumerate(segments[:-1]):
+                if seg in ROUTE_PREFIXES:
+                    key = segments[i + 1]
+                    break
+        if not key:
+            return self.default
+        return self.by_id.get(key) or self.by_token.get(key)
+
+
+# ====== Index cache ======
+def estimate_bytes(obj, _seen=None):
+    """Rough deep size of FAQ items (dicts/lists of strings and numbers)."""
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(estimate_bytes(k, _seen) + estimate_bytes(v, _seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(estimate_bytes(v, _seen) for v in obj)
+    return size
+
+
+class TenantIndexCache:
+    """
+    LRU of tenant FAQ indexes bounded by estimated bytes. An index bigger than
+    the whole budget is served but not kept. Failed loads (None) are not cached.
+    Concurrent misses for the same tenant wait for the first caller's load
+    instead of each starting their own table scan; a waiter that runs out of
+    `timeout` gets None, like a failed load.
+    """
+    def __init__(self, max_bytes=TENANT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()   # tenant id -> (items, size)
+        self._loading = {}              # tenant id -> Future of the load in flight
+        self._lock = threading.Lock()
+
+    def get(self, tenant_id, loader, timeout=None):
+        with self._lock:
+            entry = self._entries.get(tenant_id)
+            if entry is not None:
+                self._entries.move_to_end(tenant_id)
+                self.hits += 1
+                return entry[0]
+            pending = self._loading.get(tenant_id)
+            if pending is None:
+                self.misses += 1
+                pending = self._loading[tenant_id] = Future()
+                owner = True
+            else:
+                self.coalesced += 1
+                owner = False
+
+        if not owner:
+            try:
+                return pending.result(timeout)
+            except FutureTimeout:
+                return None
+        try:
+            items = self._load(tenant_id, loader)
+        except BaseException as e:
+            with self._lock:
+                self._loading.pop(tenant_id, None)
+            pending.set_exception(e)
+            raise
+        pending.set_result(items)
+        return items
+
+    def _load(self, tenant_id, loader):
+        items = loader()   # outside the lock: this is a DynamoDB scan
+        if items is None:
+            with self._lock:
+                self._loading.pop(tenant_id, None)
+            return None
+        size = estimate_bytes(items)
+        if size > self.max_bytes:
+            print(f"Tenant index {tenant_id!r} is {size} bytes, over the {self.max_bytes} byte budget; not caching")
+            with self._lock:
+                self._loading.pop(tenant_id, None)
+            return items
+
+        with self._lock:
+            self._loading.pop(tenant_id, None)
+            old = self._entries.pop(tenant_id, None)
+            if old is not None:
+                self.bytes -= old[1]
+            while self._entries and self.bytes + size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+            self._entries[tenant_id] = (items, size)
+            self.bytes += size
+        return items
+
+    def invalidate(self, tenant_id=None):
+        with self._lock:
+            if tenant_id is None:
+                self._entries.clear()
+                self.bytes = 0
+            else:
+                entry = self._entries.pop(tenant_id, None)
+                if entry is not None:
+                    self.bytes -= entry[1]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# ====== Benchmark ======
+def _synthetic_index(tenant_id, faqs):
+    return [{
+        "id": f"{tenant_id}-faq{i:03d}",
+        "category": f"category{i % 12}",
+        "answer": f"Answer {i} for {tenant_id}. " * 6,
+        **{("question" if q == 1 else f"question{q}"): f"How do I ask question {i} variant {q} at {tenant_id}?"
+           for q in range(1, 9)},
+    } for i in range(faqs)]
+
+def bench(tenants=200, requests=20000, faqs=40, budget_tenants=20, load_ms=80.0, seed=7):
+    """
+    Replay hot-tenant (Zipf) and long-tail (uniform) traffic through the cache.
+    Indexes are prebuilt and each miss is charged `load_ms` of simulated scan
+    time, so no AWS access is needed; "cache us/req" is the cache's own cost.
+    """
+    import random
+    from time import perf_counter
+
+    per_index = estimate_bytes(_synthetic_index("t0000", faqs))
+    max_bytes = per_index * budget_tenants
+    ids = [f"t{i:04d}" for i in range(tenants)]
+    rng = random.Random(seed)
+    weights = [1.0 / (rank + 1) ** 1.1 for rank in range(tenants)]
+    patterns = {
+        "hot-tenant": rng.choices(ids, weights=weights, k=requests),
+        "long-tail": [rng.choice(ids) for _ in range(requests)],
+    }
+
+    print(f"{tenants} tenants x {faqs} FAQs (~{per_index // 1024} KiB each), "
+          f"budget {max_bytes // 1024} KiB (~{budget_tenants} indexes), {requests} requests")
+    print(f"{'pattern':>11} {'hit rate':>9} {'misses':>7} {'evictions':>9} {'resident':>9} "
+          f"{'KiB used':>9} {'cache us/req':>12} {'est. load s':>11}")
+    indexes = {t: _synthetic_index(t, faqs) for t in ids}
+    for name, trace in patterns.items():
+        cache = TenantIndexCache(max_bytes)
+        start = perf_counter()
+        for tenant_id in trace:
+            cache.get(tenant_id, lambda t=tenant_id: indexes[t])
+        elapsed = perf_counter() - start
+        hit_rate = cache.hits / len(trace)
+        print(f"{name:>11} {hit_rate:>8.1%} {cache.misses:>7} {cache.evictions:>9} {len(cache):>9} "
+              f"{cache.bytes // 1024:>9} {elapsed / len(trace) * 1e6:>12.1f} "
+              f"{cache.misses * load_ms / 1000:>11.1f}")
+
+    # Cold-tenant burst: concurrent first requests should share one scan
+    from concurrent.futures import ThreadPoolExecutor
+    from time import sleep
+    cache = TenantIndexCache(max_bytes)
+    scans = []
+    def slow_load():
+        scans.append(1)
+        sleep(load_ms / 1000)
+        return indexes[ids[-1]]
+    burst = 32
+    with ThreadPoolExecutor(max_workers=burst) as pool:
+        list(pool.map(lambda _: cache.get(ids[-1], slow_load), range(burst)))
+    print(f"cold burst: {burst} concurrent requests -> {len(scans)} scan(s), {cache.coalesced} waited on it")
+
+    # Waiters with less time left than the scan takes give up instead of blocking
+    cache, scans = TenantIndexCache(max_bytes), []
+    timeout = load_ms / 4000
+    with ThreadPoolExecutor(max_workers=burst) as pool:
+        got = list(pool.map(lambda _: cache.get(ids[-1], slow_load, timeout), range(burst)))
+    print(f"short budget: {sum(g is None for g in got)} of {cache.coalesced} waiters gave up "
+          f"after {timeout * 1000:.0f} ms, {len(scans)} scan(s)")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Tenant index cache benchmark.")
+    parser.add_argument("--bench", action="store_true")
+    parser.add_argument("--tenants", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--faqs", type=int, default=40)
+    parser.add_argument("--budget-tenants", type=int, default=20, help="budget expressed in index sizes")
+    parser.add_argument("--load-ms", type=float, default=80.0, help="simulated cost of one table scan")
+    args = parser.parse_args()
+    if args.bench:
+        bench(args.tenants, args.requests, args.faqs, args.budget_tenants, args.load_ms)
+    else:
+        parser.print_help()